@@ -25,152 +25,403 @@ Forms
 
 import csv
 import email
-import re
+import io
+import os
+import queue
 import ssl
+import threading
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import deque
+from contextlib import closing
+from dataclasses import dataclass, fields
 from email import policy
+from email.parser import BytesHeaderParser
 from getpass import getpass
 from imaplib import IMAP4_SSL
+from operator import attrgetter
 
 # Global constants
-EXTRACTION_REGEXP = re.compile(
-    r"X-Mailer: WPMailSMTP/Mailer/smtp \d\.\d\.\d"
-    r"\nMIME-Version: \d\.\d"
-    r"\nContent-Type: text\/plain; charset=UTF-8"
-    r"(\nContent-Transfer-Encoding: 8bit)?"
-    r"\n"
-    r"\n"
-    r"\"eintrags_id\",\"key\",\"anzahl_personen\",\"zahlungsstatus\","
-    r"\"name\",\"vorname\",\"mail\",\"telefon\",\"sonstiges\","
-    r"\"club\",\"teilnehmer_2\",\"teilnehmer_3\",\"teilnehmer_4\","
-    r"\"teilnehmer_5\",\"teilnehmer_6\",\"teilnehmer_7\","
-    r"\n\"(?P<eintrags_id>\d+)\",\"(?P<key>[^\"]+)\","
-    r"\"(?P<anzahl_personen>\d+)\",\"(?P<zahlungsstatus>[^\"]*)\","
-    r"\"(?P<name>[^\"]+)\",\"(?P<vorname>[^\"]+)\",\"(?P<mail>[^\"]+)\","
-    r"\"(?P<telefon>[^\"]*)\",\"(?P<sonstiges>[^\"]*)\","
-    r"\"(?P<club>[^\"]*)\","
-    r"\"(?P<teilnehmer_2>[^\"]*)\",\"(?P<teilnehmer_3>[^\"]*)\","
-    r"\"(?P<teilnehmer_4>[^\"]*)\",\"(?P<teilnehmer_5>[^\"]*)\","
-    r"\"(?P<teilnehmer_6>[^\"]*)\",\"(?P<teilnehmer_7>[^\"]*)\""
-)
+CSV_WRITE_BUFFER_SIZE = 1 << 20
+FETCH_PIPELINE_DEPTH = 4
+HEADER_FETCH_QUERY = \
+        '(BODY.PEEK[HEADER.FIELDS (X-ENVELOPE-FROM X-ENVELOPE-TO FROM TO)])'
 MAILBOX_FOR_DOWNLOAD = 'Registrations'
+PREFETCH_BATCHES = 4
+SEARCH_CRITERIA = \
+        '(HEADER From "some_address@example.org"' \
+        ' HEADER To "another_address@example.org"' \
+        ' HEADER To "further_address@example.org")'
 
+# Marker for the end of the items of _prefetch_in_background
+_PREFETCH_DONE = object()
+
+@dataclass(slots=True)
 class RegistrationData: # pylint: disable=too-many-instance-attributes
     """Class representing the extracted data from one registration e-mail
 
     """
-    def __init__(self,  data):
-        """Initialize a new instance from a dictionary of the e-mail's data
+    eintrags_id: str
+    key: str
+    anzahl_personen: str
+    zahlungsstatus: str
+    name: str
+    vorname: str
+    mail: str
+    telefon: str
+    sonstiges: str
+    club: str
+    teilnehmer_2: str
+    teilnehmer_3: str
+    teilnehmer_4: str
+    teilnehmer_5: str
+    teilnehmer_6: str
+    teilnehmer_7: str
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a new instance from a dictionary of the e-mail's data
 
         """
-        self.eintrags_id = data['eintrags_id']
-        self.key = data['key']
-        self.anzahl_personen = data['anzahl_personen']
-        self.zahlungsstatus = data['zahlungsstatus']
-        self.name = data['name']
-        self.vorname = data['vorname']
-        self.mail = data['mail']
-        self.telefon = data['telefon']
-        self.sonstiges = data['sonstiges']
-        self.club = data['club']
-        self.teilnehmer_2 = data['teilnehmer_2']
-        self.teilnehmer_3 = data['teilnehmer_3']
-        self.teilnehmer_4 = data['teilnehmer_4']
-        self.teilnehmer_5 = data['teilnehmer_5']
-        self.teilnehmer_6 = data['teilnehmer_6']
-        self.teilnehmer_7 = data['teilnehmer_7']
+        return cls(**{field: data[field] for field in CSV_FIELDS})
 
     @staticmethod
     def write_header_to_csv(csv_obj):
         """Write an applicable header to an object returned by csv.writer
 
         """
-        csv_obj.writerow(
-            [
-                'eintrags_id', 'key', 'anzahl_personen', 'zahlungsstatus',
-                'name', 'vorname', 'mail', 'telefon', 'sonstiges', 'club',
-                'teilnehmer_2', 'teilnehmer_3', 'teilnehmer_4',
-                'teilnehmer_5', 'teilnehmer_6', 'teilnehmer_7'
-            ]
-        )
+        csv_obj.writerow(CSV_FIELDS)
 
-    def write_to_csv(self, csv_obj):
-        """Write the instance data to an object returned by csv.writer
+# Constants derived from RegistrationData, whose fields are the single source
+# of the column names
+CSV_FIELDS = tuple(field.name for field in fields(RegistrationData))
+CSV_HEADER_LINE = ''.join(f'"{field}",' for field in CSV_FIELDS)
+CSV_HEADER_LINE_BYTES = CSV_HEADER_LINE.encode('ascii')
+# Unlike dataclasses.astuple this does not deep-copy the values of each row
+CSV_ROW_GETTER = attrgetter(*CSV_FIELDS)
 
-        """
-        csv_obj.writerow(
-            [
-                self.eintrags_id, self.key, self.anzahl_personen,
-                self.zahlungsstatus, self.name, self.vorname, self.mail,
-                self.telefon, self.sonstiges, self.club, self.teilnehmer_2,
-                self.teilnehmer_3, self.teilnehmer_4, self.teilnehmer_5,
-                self.teilnehmer_6, self.teilnehmer_7
-            ]
+def _batched(seq, size):
+    """Yield consecutive slices of at most "size" elements from "seq"
+
+    """
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+def _extract_uid(response_line):
+    """Extract the UID from a part of the response to a UID FETCH command
+
+    None is returned if the part does not contain the UID.
+    """
+    tokens = response_line.replace(b'(', b' ').replace(b')', b' ').split()
+    try:
+        return tokens[tokens.index(b'UID') + 1]
+    except (IndexError, ValueError):
+        return None
+
+def _fetch_in_batches(imap_conn, uids, batch_size, message_parts):
+    """Download "message_parts" of the messages with the given UIDs in batches
+
+    Up to FETCH_PIPELINE_DEPTH requests are sent before awaiting the response
+    to the first of them, so the server has no need to wait for the next one.
+    Yields a tuple of the UID and the downloaded data for each message.
+    """
+    # imaplib has no public interface for pipelining commands, so this mirrors
+    # what IMAP4.uid does in its separate steps
+    # pylint: disable=protected-access
+    pending_tags = deque()
+
+    def complete_oldest_request():
+        typ, data = imap_conn._command_complete('UID', pending_tags.popleft())
+        # Unlike BAD a NO reply raises no exception, but dropping the messages
+        # of the whole batch silently is no option either
+        if typ != 'OK':
+            raise imap_conn.error(f"UID FETCH failed: {data!r}")
+        # Responses to requests still pending may already have been collected
+        # here, which is fine since each message carries its UID
+        _typ, data = imap_conn._untagged_response(typ, data, 'FETCH')
+        # Each message is a tuple of the response line and the actual message
+        # data, followed by the rest of the response. The server may send the
+        # UID in either of them.
+        message_data = None
+        for item in data:
+            if message_data is not None:
+                uid = None if isinstance(item, tuple) else _extract_uid(item)
+                if uid is None:
+                    raise imap_conn.error(
+                        f"UID missing in FETCH response before {item!r}"
+                    )
+                yield uid, message_data
+                message_data = None
+            elif isinstance(item, tuple):
+                uid = _extract_uid(item[0])
+                if uid is not None:
+                    yield uid, item[1]
+                else:
+                    message_data = item[1]
+        if message_data is not None:
+            raise imap_conn.error("UID missing at the end of FETCH response")
+
+    for batch in _batched(uids, batch_size):
+        pending_tags.append(
+            imap_conn._command('UID', 'FETCH', b','.join(batch), message_parts)
         )
+        if len(pending_tags) >= FETCH_PIPELINE_DEPTH:
+            yield from complete_oldest_request()
+    while pending_tags:
+        yield from complete_oldest_request()
 
-def check_if_message_to_skip(msg):
-    """Check if an e-mail message is to be skipped
+def _prefetch_in_background(iterable, max_buffered):
+    """Consume "iterable" in a background thread, yielding its items
 
+    At most "max_buffered" items are kept waiting. Exceptions raised by
+    "iterable" are re-raised in the consuming thread.
+    """
+    items = queue.Queue(max_buffered)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stop.is_set():
+                    return
+        except Exception as exc: # pylint: disable=broad-except
+            items.put((_PREFETCH_DONE, exc))
+        else:
+            items.put((_PREFETCH_DONE, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            if item is _PREFETCH_DONE:
+                break
+            yield item
+    finally:
+        # Unblock the producer in case it is waiting for free space
+        stop.set()
+        while producer.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
+
+def _find_registration_row(body, header_line):
+    """Parse the CSV line following "header_line" in "body" into a list
+
+    None is returned if "header_line" or the line following it is missing.
+    """
+    start = body.find(header_line)
+    if start < 0:
+        return None
+
+    # Skip the header line and parse the record following it, which may span
+    # several lines if a quoted field contains line breaks. The reader stops
+    # at the end of that record.
+    line_start = body.find('\n', start + len(header_line)) + 1
+    if line_start == 0:
+        return None
+    row = next(csv.reader(io.StringIO(body[line_start:], newline='')), None)
+    if row is None:
+        return None
+    # Line breaks within fields are normalized to how the email package
+    # returns them
+    return [field.replace('\r\n', '\n') for field in row]
+
+def extract_registration_data(body):
+    """Extract the registration data from the text body of an e-mail
+
+    The body is expected to contain a CSV header line listing CSV_FIELDS,
+    directly followed by a CSV record with the data of the registration.
+    None is returned if no such data could be found.
+    """
+    row = _find_registration_row(body, CSV_HEADER_LINE)
+    if row is None:
+        return None
+    # Like the header line, the data line may end with a trailing comma
+    if len(row) == len(CSV_FIELDS) + 1 and row[-1] == '':
+        row.pop()
+    if len(row) != len(CSV_FIELDS):
+        return None
+
+    return dict(zip(CSV_FIELDS, row))
+
+def _extract_registration_data_from_message(raw_email):
+    """Extract the registration data from an e-mail after fully parsing it
+
+    This is the slow path for e-mails whose body cannot be located or
+    searched in the raw data, e.g. due to bare LF line endings.
     """
-    return (msg['X-Envelope-From'] != '<some_address@example.org>') \
-            or (msg['X-Envelope-To'] != '<another_address@example.org>') \
-            or (msg['From'] != '<some_address@example.org>') \
-            or (msg['To'] != 'another_address@example.org, further_address@example.org')
+    # Create an email.message instance directly from the data
+    msg = email.message_from_bytes(raw_email, policy=policy.default)
 
-def retrieve_registrations_from_server(cmdline_args):
-    """Retrieve registrations from server
+    # Search only the plain text part instead of the whole message, falling
+    # back to the raw data if there is no such part
+    text_part = msg.get_body(preferencelist=('plain',))
+    if text_part is not None:
+        body = text_part.get_content()
+    else:
+        body = raw_email.decode('utf-8', 'replace')
+    return extract_registration_data(body)
+
+def _print_missing_registration_data(uid):
+    """Report that the e-mail with the given UID lacks registration data
 
-    Seemingly irrelevant e-mails are being filtered out.
     """
-    # Create list to collect all registrations
-    registrations = list()
+    print(f"Skipping e-mail with UID {uid.decode('ascii')} without "
+          "registration data")
 
+def _unfolded_header(msg, name):
+    """Return the value of the header "name" of "msg" without line folding
+
+    Also surrounding whitespace is removed. None is returned if the header is
+    missing.
+    """
+    value = msg[name]
+    if value is None:
+        return None
+    # Under compat32 headers containing raw 8-bit bytes are returned as
+    # email.header.Header instances instead of strings
+    return str(value).replace('\r\n', '').replace('\n', '').strip()
+
+def check_if_message_to_skip(msg):
+    """Check if an e-mail message is to be skipped
+
+    The unfolded header values are compared verbatim, so "msg" is best parsed
+    with the compat32 policy which leaves e.g. the angle brackets around a
+    single address in place.
+    """
+    return (_unfolded_header(msg, 'X-Envelope-From')
+            != '<some_address@example.org>') \
+            or (_unfolded_header(msg, 'X-Envelope-To')
+                != '<another_address@example.org>') \
+            or (_unfolded_header(msg, 'From')
+                != '<some_address@example.org>') \
+            or (_unfolded_header(msg, 'To')
+                != 'another_address@example.org, further_address@example.org')
+
+def connect_to_server(cmdline_args):
+    """Log in to the server and select the mailbox holding the registrations
+
+    The connection is returned for use as context manager, ensuring an
+    automatic logout. It is logged out right away if logging in or selecting
+    the mailbox fails.
+    """
     # Create a safe default configuration for the SSL connect
     ssl_cntxt = ssl.create_default_context()
-    # Establish a context for the connection to the mail server, ensuring
-    # automatic logout
-    with IMAP4_SSL(
-            host=cmdline_args.server_url, port=cmdline_args.port,
-            ssl_context=ssl_cntxt, timeout=10) as imap_conn:
+    imap_conn = IMAP4_SSL(
+        host=cmdline_args.server_url, port=cmdline_args.port,
+        ssl_context=ssl_cntxt, timeout=10
+    )
+    try:
         # Identify the client using a password
         imap_conn.login(
             cmdline_args.imap_user,
-            getpass("Please enter the password of \"" + cmdline_args.imap_user + "\": ")
+            getpass(f"Please enter the password of \"{cmdline_args.imap_user}\": ")
         )
 
         # Choose the mailbox to operate on and forbid modifications
-        imap_conn.select(MAILBOX_FOR_DOWNLOAD, readonly=True)
-
-        # Query the server for all messages in the selected mailbox
-        _tmp, data = imap_conn.search(None, 'ALL')
-
-        # Process all messages in the mailbox
-        for idx in data[0].split():
-            # Download the message with index "idx" entirely
-            _typ, data = imap_conn.fetch(idx, '(RFC822)')
-            # Filter for the actual message data
-            raw_email = data[0][1]
-            # Convert the e-mail's bytes to text by assuming a UTF-8 encoding
-            decoded = raw_email.decode('utf-8')
-            # Create an email.message instance from the data
-            msg = email.message_from_string(decoded, policy=policy.strict)
-
-            if check_if_message_to_skip(msg):
-                print(
-                    "Skipping e-mail from \"{0}\" to \"{1}\"".format(
-                        msg['X-Envelope-From'], msg['X-Envelope-To']
-                    )
+        typ, data = imap_conn.select(MAILBOX_FOR_DOWNLOAD, readonly=True)
+        if typ != 'OK':
+            raise imap_conn.error(f"SELECT failed: {data!r}")
+    except BaseException:
+        imap_conn.logout()
+        raise
+
+    return imap_conn
+
+def iter_registrations(imap_conn, cmdline_args):
+    """Retrieve registrations from server, yielding them as they arrive
+
+    "imap_conn" must be a connection returned by connect_to_server.
+    Seemingly irrelevant e-mails are being filtered out.
+    """
+    # Query the server for the UIDs of all seemingly relevant messages in
+    # the selected mailbox, which unlike sequence numbers stay stable
+    # across requests
+    typ, data = imap_conn.uid('SEARCH', None, SEARCH_CRITERIA)
+    if typ != 'OK':
+        raise imap_conn.error(f"UID SEARCH failed: {data!r}")
+
+    # Download only the headers needed to decide which messages to skip.
+    # Since the server matches header substrings only, this check is
+    # still needed.
+    kept_uids = list()
+    # The compat32 policy leaves the header values as they are instead of
+    # parsing them, which suffices for comparing them to plain strings
+    header_parser = BytesHeaderParser(policy=policy.compat32)
+    for uid, raw_headers in _fetch_in_batches(
+            imap_conn, data[0].split(), cmdline_args.fetch_batch,
+            HEADER_FETCH_QUERY):
+        # Create an email.message instance from the header data
+        msg = header_parser.parsebytes(raw_headers)
+
+        if check_if_message_to_skip(msg):
+            print(
+                f"Skipping e-mail from \"{msg['X-Envelope-From']}\" to "
+                f"\"{msg['X-Envelope-To']}\""
+            )
+            continue
+
+        kept_uids.append(uid)
+
+    # Download the remaining messages entirely in a background thread,
+    # parsing already downloaded ones meanwhile. No other IMAP commands
+    # may be issued until this is finished.
+    for uid, raw_email in _prefetch_in_background(
+            _fetch_in_batches(
+                imap_conn, kept_uids, cmdline_args.fetch_batch,
+                '(BODY.PEEK[])'),
+            PREFETCH_BATCHES * cmdline_args.fetch_batch):
+        # Cheaply reject messages lacking the CSV header before parsing
+        # them. The notifications are sent 8bit encoded, so the header is
+        # contained verbatim in the raw data.
+        if CSV_HEADER_LINE_BYTES not in raw_email:
+            _print_missing_registration_data(uid)
+            continue
+
+        # Since the notifications consist of a single 8bit encoded text
+        # part, the body usually follows the headers verbatim and there
+        # is no need to parse the whole e-mail. Bodies which are not valid
+        # UTF-8 are left to the email package, which honours the declared
+        # charset.
+        _headers, separator, raw_body = raw_email.partition(b'\r\n\r\n')
+        registration_data = None
+        if separator:
+            try:
+                registration_data = extract_registration_data(
+                    raw_body.decode('utf-8')
                 )
-                continue
+            except UnicodeDecodeError:
+                pass
+        if registration_data is None:
+            registration_data = _extract_registration_data_from_message(
+                raw_email
+            )
+        if registration_data is None:
+            _print_missing_registration_data(uid)
+            continue
 
-            res = EXTRACTION_REGEXP.search(str(msg))
-            registrations.append(RegistrationData(res.groupdict()))
+        yield RegistrationData.from_dict(registration_data)
 
-        # Close the currently selected mailbox
-        imap_conn.close()
+    # Close the currently selected mailbox
+    imap_conn.close()
 
-    return registrations
+def _positive_int(value):
+    """Convert a commandline argument to an integer of at least 1
+
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(f"\"{value}\" is not a positive integer")
+    return number
 
 def parse_commandline_arguments():
     """Pass the commandline arguments passed to this script
@@ -180,6 +431,11 @@ def parse_commandline_arguments():
         description="Extract registrations from Formidable Forms e-mail notifications"
     )
 
+    parser.add_argument(
+        '-b', '--fetch-batch', default=100,
+        help='the number of e-mails to download per request',
+        type=_positive_int
+    )
     parser.add_argument(
         '-p', '--port', default=993,
         help='the port to connect to the IMAP server', type=int
@@ -197,14 +453,23 @@ def parse_commandline_arguments():
     return parser.parse_args()
 
 def write_registrations_to_csv(registrations, export_file_name):
-    """Export a list of RegistrationData objects to a CSV file
+    """Export an iterable of RegistrationData objects to a CSV file
 
     """
-    with open(export_file_name, 'wt', newline='') as csv_file:
-        csv_writer = csv.writer(csv_file)
-        RegistrationData.write_header_to_csv(csv_writer)
-        for entry in registrations:
-            entry.write_to_csv(csv_writer)
+    # Write to a temporary file first, so that an aborted export does not
+    # replace a previous one
+    partial_file_name = export_file_name + '.part'
+    try:
+        with open(
+                partial_file_name, 'wt', buffering=CSV_WRITE_BUFFER_SIZE,
+                encoding='utf-8', newline='') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            RegistrationData.write_header_to_csv(csv_writer)
+            csv_writer.writerows(map(CSV_ROW_GETTER, registrations))
+    except BaseException:
+        os.remove(partial_file_name)
+        raise
+    os.replace(partial_file_name, export_file_name)
 
 def main():
     """Main method and entry point of mail_from_formidable_forms_extractor
@@ -212,9 +477,12 @@ def main():
     """
     args = parse_commandline_arguments()
 
-    registrations = retrieve_registrations_from_server(args)
-
-    write_registrations_to_csv(registrations, 'exported_registrations.csv')
+    # Connect before touching the export file, so e.g. a wrong password does
+    # not affect it. The iteration is closed explicitly before logging out,
+    # ensuring no download is still running on the connection.
+    with connect_to_server(args) as imap_conn, \
+            closing(iter_registrations(imap_conn, args)) as registrations:
+        write_registrations_to_csv(registrations, 'exported_registrations.csv')
 
 if __name__ == "__main__":
     main()
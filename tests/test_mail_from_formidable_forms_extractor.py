@@ -0,0 +1,257 @@
+"""Tests of mail_from_formidable_forms_extractor
+
+"""
+
+import imaplib
+import os
+import sys
+import threading
+import unittest
+
+from email import policy
+from email.parser import BytesHeaderParser
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+)
+
+# pylint: disable=wrong-import-position
+import mail_from_formidable_forms_extractor as extractor
+
+def _registration_body(data_line, line_ending='\r\n'):
+    """Create an e-mail body containing the CSV header and "data_line"
+
+    """
+    return (
+        f"Neue Anmeldung{line_ending}{extractor.CSV_HEADER_LINE}{line_ending}"
+        f"{data_line}{line_ending}"
+    )
+
+def _data_line(values):
+    """Create a CSV data line quoting all of "values" like Formidable Forms
+
+    """
+    return ','.join(f'"{value}"' for value in values)
+
+VALUES = [f"value_{idx}" for idx in range(len(extractor.CSV_FIELDS))]
+
+class ExtractRegistrationDataTest(unittest.TestCase):
+    """Tests of extract_registration_data
+
+    """
+    def test_complete_row(self):
+        """A row with all fields is extracted"""
+        data = extractor.extract_registration_data(
+            _registration_body(_data_line(VALUES))
+        )
+        self.assertEqual(data, dict(zip(extractor.CSV_FIELDS, VALUES)))
+
+    def test_trailing_comma(self):
+        """A row ending with a comma like the header line is extracted"""
+        data = extractor.extract_registration_data(
+            _registration_body(_data_line(VALUES) + ',')
+        )
+        self.assertEqual(data, dict(zip(extractor.CSV_FIELDS, VALUES)))
+
+    def test_too_few_fields(self):
+        """A row lacking fields is rejected"""
+        self.assertIsNone(extractor.extract_registration_data(
+            _registration_body(_data_line(VALUES[:-1]))
+        ))
+
+    def test_missing_header(self):
+        """A body without the CSV header is rejected"""
+        self.assertIsNone(extractor.extract_registration_data(
+            _data_line(VALUES)
+        ))
+
+    def test_multi_line_field(self):
+        """A quoted field may contain line breaks"""
+        for line_ending in ('\n', '\r\n'):
+            values = list(VALUES)
+            values[extractor.CSV_FIELDS.index('sonstiges')] = \
+                f"line one{line_ending}line two"
+            data = extractor.extract_registration_data(
+                _registration_body(_data_line(values), line_ending)
+            )
+            self.assertEqual(data['sonstiges'], "line one\nline two")
+            self.assertEqual(data['teilnehmer_7'], VALUES[-1])
+
+MATCHING_HEADERS = (
+    b"X-Envelope-From: <some_address@example.org>\r\n"
+    b"X-Envelope-To: <another_address@example.org>\r\n"
+    b"From: <some_address@example.org>\r\n"
+    b"To: another_address@example.org, further_address@example.org\r\n"
+    b"\r\n"
+)
+
+def _parse_headers(raw_headers):
+    """Parse "raw_headers" the way iter_registrations does
+
+    """
+    return BytesHeaderParser(policy=policy.compat32).parsebytes(raw_headers)
+
+class CheckIfMessageToSkipTest(unittest.TestCase):
+    """Tests of check_if_message_to_skip
+
+    """
+    def test_matching_headers(self):
+        """An e-mail with the expected headers is kept"""
+        self.assertFalse(extractor.check_if_message_to_skip(
+            _parse_headers(MATCHING_HEADERS)
+        ))
+
+    def test_folded_header(self):
+        """Folded header values are compared unfolded"""
+        self.assertFalse(extractor.check_if_message_to_skip(_parse_headers(
+            MATCHING_HEADERS.replace(b", further", b",\r\n further")
+        )))
+
+    def test_other_sender(self):
+        """An e-mail from another sender is skipped"""
+        self.assertTrue(extractor.check_if_message_to_skip(_parse_headers(
+            MATCHING_HEADERS.replace(b"From: <some", b"From: <other")
+        )))
+
+    def test_missing_header(self):
+        """An e-mail lacking one of the headers is skipped"""
+        self.assertTrue(extractor.check_if_message_to_skip(_parse_headers(
+            MATCHING_HEADERS.replace(b"X-Envelope-To", b"X-Other")
+        )))
+
+    def test_8bit_header(self):
+        """Headers with raw 8-bit bytes are skipped instead of failing"""
+        self.assertTrue(extractor.check_if_message_to_skip(_parse_headers(
+            MATCHING_HEADERS.replace(
+                b"further_address@", b"further_address@\xc3\xa4"
+            )
+        )))
+
+class FakeIMAP4(imaplib.IMAP4):
+    """IMAP4 connection to a scripted in-memory server
+
+    Only CAPABILITY and UID FETCH are understood. The server replies to each
+    command as soon as it is sent, which allows pipelining commands.
+    """
+    def __init__(self, messages, uid_after_literal=False,
+                 unsolicited_fetch=False, fetch_reply=b'OK'):
+        self.messages = messages
+        self.uid_after_literal = uid_after_literal
+        self.unsolicited_fetch = unsolicited_fetch
+        self.fetch_reply = fetch_reply
+        self.output = bytearray()
+        super().__init__()
+        self.state = 'SELECTED'
+
+    def open(self, host='', port=imaplib.IMAP4_PORT, timeout=None):
+        self.output += b'* OK ready\r\n'
+
+    def read(self, size):
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def readline(self):
+        return self.read(self.output.index(b'\n') + 1)
+
+    def send(self, data):
+        tag, command = data.rstrip(b'\r\n').split(b' ', 1)
+        if command == b'CAPABILITY':
+            self.output += b'* CAPABILITY IMAP4rev1\r\n' + tag \
+                    + b' OK CAPABILITY done\r\n'
+            return
+
+        uids = command.split(b' ')[2].split(b',')
+        if self.fetch_reply == b'OK':
+            for seq_num, uid in enumerate(uids, 1):
+                self._send_message(seq_num, uid)
+        if self.unsolicited_fetch:
+            self.output += b'* 42 FETCH (FLAGS (\\Seen))\r\n'
+        self.output += tag + b' ' + self.fetch_reply + b' UID FETCH done\r\n'
+
+    def _send_message(self, seq_num, uid):
+        message = self.messages[uid]
+        literal = b'BODY[] {' + str(len(message)).encode() + b'}\r\n' \
+                + message
+        if self.uid_after_literal:
+            self.output += f'* {seq_num} FETCH ('.encode() + literal \
+                    + b' UID ' + uid + b')\r\n'
+        else:
+            self.output += f'* {seq_num} FETCH (UID '.encode() + uid + b' ' \
+                    + literal + b')\r\n'
+
+    def shutdown(self):
+        pass
+
+MESSAGES = {
+    str(uid).encode(): f"message {uid}".encode() for uid in range(1, 12)
+}
+
+class FetchInBatchesTest(unittest.TestCase):
+    """Tests of _fetch_in_batches
+
+    """
+    def _fetch(self, imap_conn):
+        """Fetch all MESSAGES in batches of 2 messages"""
+        return list(extractor._fetch_in_batches( # pylint: disable=protected-access
+            imap_conn, list(MESSAGES), 2, '(BODY.PEEK[])'
+        ))
+
+    def test_uid_before_literal(self):
+        """The UID may precede the message data"""
+        self.assertEqual(
+            self._fetch(FakeIMAP4(MESSAGES)), list(MESSAGES.items())
+        )
+
+    def test_uid_after_literal(self):
+        """The UID may follow the message data"""
+        self.assertEqual(
+            self._fetch(FakeIMAP4(MESSAGES, uid_after_literal=True)),
+            list(MESSAGES.items())
+        )
+
+    def test_unsolicited_fetch(self):
+        """Unsolicited FETCH responses without message data are ignored"""
+        self.assertEqual(
+            self._fetch(FakeIMAP4(MESSAGES, unsolicited_fetch=True)),
+            list(MESSAGES.items())
+        )
+
+    def test_no_reply(self):
+        """A NO reply raises an exception instead of losing messages"""
+        with self.assertRaises(imaplib.IMAP4.error):
+            self._fetch(FakeIMAP4(MESSAGES, fetch_reply=b'NO'))
+
+class PrefetchInBackgroundTest(unittest.TestCase):
+    """Tests of _prefetch_in_background
+
+    """
+    # pylint: disable=protected-access
+    def test_all_items_in_order(self):
+        """All items are yielded in their original order"""
+        self.assertEqual(
+            list(extractor._prefetch_in_background(iter(range(100)), 3)),
+            list(range(100))
+        )
+
+    def test_producer_exception(self):
+        """Exceptions of the producer are re-raised for the consumer"""
+        def failing_items():
+            yield 1
+            raise ValueError("producer failed")
+
+        items = extractor._prefetch_in_background(failing_items(), 3)
+        self.assertEqual(next(items), 1)
+        with self.assertRaisesRegex(ValueError, "producer failed"):
+            next(items)
+
+    def test_consumer_closing_early(self):
+        """Closing the consumer early stops the producer"""
+        threads_before = threading.active_count()
+        items = extractor._prefetch_in_background(iter(range(10000)), 2)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(threading.active_count(), threads_before)
+
+if __name__ == '__main__':
+    unittest.main()